@@ -8,17 +8,27 @@ Provides a `%diagram` line magic that:
   2. File upload widget (remote environments like Colab)
   3. Folder-based capture (local fallback, looks in ~/Desktop)
 - Copies captured images into a `diagrams/` folder in the current working directory.
-- Prints ready-to-use Markdown plus a preview image.
+- Shows ready-to-use Markdown with a "Copy Markdown" button, plus a preview image.
 """
 
 from __future__ import annotations
 
+import base64
+import binascii
+import html
 import io
+import json
 import os
-import shutil
-import subprocess
-from datetime import datetime
-from typing import Optional
+import re
+import struct
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:  # pragma: no cover - only needed for annotations
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
 
 # Default configuration (can be overridden via env var or by editing the module
 # after import). The default URL is intentionally a non-personal placeholder;
@@ -32,43 +42,96 @@ DIAGRAM_DIR: str = "diagrams"
 ADB_DEVICE_SERIAL: Optional[str] = os.getenv("SUPERNOTE_CANVAS_ADB_DEVICE", None)
 
 
+_IN_IPYTHON: Optional[bool] = None
+
+
 def _in_ipython() -> bool:
     """Return True if running inside IPython (including Jupyter)."""
+    global _IN_IPYTHON
+    if _IN_IPYTHON is not None:
+        return _IN_IPYTHON
+
+    # An IPython shell cannot be running unless IPython has been imported, so
+    # avoid paying for the import just to find out.
+    if "IPython" not in sys.modules:
+        return False
+
     try:
         from IPython import get_ipython  # type: ignore
 
-        return get_ipython() is not None
+        _IN_IPYTHON = get_ipython() is not None
     except Exception:
-        return False
+        _IN_IPYTHON = False
+    return _IN_IPYTHON
+
+
+# Screenshot extensions considered by `_latest_screenshot` (lowercase). The scan
+# works on bytes filenames, so the bytes set is what the loop actually uses.
+_IMG_EXTS: tuple = (".png", ".jpg", ".jpeg")
+_IMG_EXTS_BYTES: frozenset = frozenset(ext.encode("ascii") for ext in _IMG_EXTS)
+
+_TRAILING_NUMBER_RE = re.compile(rb"(\d+)(?=\.[^.]+$)")
+
+
+def _trailing_number(name: bytes) -> int:
+    """Return the integer just before the file extension in `name`, or -1."""
+    match = _TRAILING_NUMBER_RE.search(name)
+    return int(match.group(1)) if match else -1
 
 
 def _latest_screenshot(path: str) -> Optional[str]:
     """
     Return the most recent screenshot file in `path` by modification time.
 
-    Considers files with extensions: .png, .jpg, .jpeg (case-insensitive).
+    Considers files with extensions: .png, .jpg, .jpeg (case-insensitive),
+    skipping hidden (dot) files.
+    Ties on modification time go to the file with the larger trailing number.
     Returns absolute path, or None if no matching files are found.
     """
-    exts = {".png", ".jpg", ".jpeg"}
+    path = os.fspath(path)
+    best_mtime = float("-inf")
+    best_path: Optional[bytes] = None
+    best_name = b""
     try:
-        candidates = []
-        for name in os.listdir(path):
-            _, ext = os.path.splitext(name)
-            if ext.lower() in exts:
-                full = os.path.join(path, name)
+        # scandir yields DirEntry objects whose stat() result is cached, which
+        # avoids a separate path join + getmtime syscall per file. Scanning a
+        # bytes path yields bytes names, so no entry is decoded to str except
+        # the winner.
+        with os.scandir(os.fsencode(path)) as it:
+            for entry in it:
+                name = entry.name
+                # Hidden files include macOS "._shot.png" AppleDouble metadata
+                # files, which match the extension but are not images. Only the
+                # short extension slice is lowercased, not the whole name.
+                if name.startswith(b".") or name[name.rfind(b".") :].lower() not in _IMG_EXTS_BYTES:
+                    continue
                 try:
-                    mtime = os.path.getmtime(full)
+                    # is_file() uses the cached d_type, skipping directories that
+                    # happen to be named like images without an extra stat.
+                    if not entry.is_file():
+                        continue
+                    mtime = entry.stat().st_mtime
                 except OSError:
                     continue
-                candidates.append((mtime, full))
+                if mtime > best_mtime or (
+                    # Tie on mtime (coarse filesystem timestamps): prefer the
+                    # larger trailing number so "shot_10" beats "shot_2".
+                    mtime == best_mtime
+                    and _trailing_number(name) > _trailing_number(best_name)
+                ):
+                    best_mtime = mtime
+                    best_path = entry.path
+                    best_name = name
     except (FileNotFoundError, NotADirectoryError, PermissionError):
         return None
 
-    if not candidates:
+    if best_path is None:
         return None
 
-    candidates.sort(key=lambda t: t[0], reverse=True)
-    return os.path.abspath(candidates[0][1])
+    # entry.path is already absolute when `path` is (e.g. the default
+    # SCREENSHOT_DIR), so only resolve relative paths against the cwd.
+    result = os.fsdecode(best_path)
+    return result if os.path.isabs(path) else os.path.abspath(result)
 
 
 def latest_screenshot(path: str) -> Optional[str]:
@@ -80,175 +143,833 @@ def latest_screenshot(path: str) -> Optional[str]:
     return _latest_screenshot(path)
 
 
-def _is_adb_available() -> bool:
-    """Return True if ADB is available in PATH."""
+# Cached results of the ADB probes. Spawning `adb` costs tens to hundreds of
+# milliseconds per call, so results are reused for `_ADB_CACHE_TTL` seconds or
+# until `invalidate_adb_cache()` is called (e.g. after plugging in a device).
+_ADB_CACHE_TTL: float = 30.0
+_ADB_STATE: dict = {"checked": False, "available": False, "connected": False, "ts": 0.0}
+
+
+def invalidate_adb_cache() -> None:
+    """Forget cached ADB probe results so the next check re-runs `adb`."""
+    global _ADB_SHELL
+    _ADB_STATE.update(checked=False, available=False, connected=False, ts=0.0)
+    # The device may have been unplugged or swapped; drop the persistent shell too.
+    if _ADB_SHELL is not None:
+        _ADB_SHELL.close()
+        _ADB_SHELL = None
+
+
+def _probe_adb() -> tuple[bool, bool]:
+    """
+    Run `adb devices` once and return `(available, connected)` (uncached).
+
+    A successful `adb devices` implies ADB is on PATH, so a separate
+    `adb version` call is unnecessary.
+    """
+    import subprocess
+
     try:
         result = subprocess.run(
-            ["adb", "version"],
+            ["adb", "devices"],
             capture_output=True,
+            text=True,
             timeout=5,
             check=False,
         )
-        return result.returncode == 0
-    except (FileNotFoundError, subprocess.TimeoutExpired):
-        return False
+    except FileNotFoundError:
+        # adb is not installed / not on PATH.
+        return False, False
+    except (subprocess.TimeoutExpired, Exception):
+        return True, False
+
+    if result.returncode != 0:
+        return True, False
+
+    # Parse output: skip the "List of devices attached" header and look for a
+    # "<serial>\tdevice" line (other states include "offline" and "unauthorized").
+    for line in result.stdout.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 2 and parts[1] == "device":
+            if not ADB_DEVICE_SERIAL or parts[0] == ADB_DEVICE_SERIAL:
+                return True, True
+    return True, False
+
+
+def _adb_state() -> dict:
+    """Return the cached ADB probe results, re-probing if they are stale."""
+    now = time.time()
+    if not _ADB_STATE["checked"] or now - _ADB_STATE["ts"] >= _ADB_CACHE_TTL:
+        available, connected = _probe_adb()
+        _ADB_STATE.update(checked=True, available=available, connected=connected, ts=now)
+    return _ADB_STATE
+
+
+def _is_adb_available() -> bool:
+    """Return True if ADB is available in PATH."""
+    return _adb_state()["available"]
 
 
 def _is_device_connected() -> bool:
     """Return True if an ADB device is connected."""
-    if not _is_adb_available():
-        return False
+    return _adb_state()["connected"]
 
-    try:
-        cmd = ["adb", "devices"]
-        if ADB_DEVICE_SERIAL:
-            cmd.extend(["-s", ADB_DEVICE_SERIAL])
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=5,
-            check=False,
-        )
-        if result.returncode != 0:
-            return False
 
-        # Parse output: should have at least one device line (not just "List of devices")
-        lines = result.stdout.strip().split("\n")[1:]  # Skip header
-        devices = [line for line in lines if line.strip() and "device" in line]
-        return len(devices) > 0
-    except (subprocess.TimeoutExpired, Exception):
-        return False
+# Marker echoed after each screencap so the reader knows where the output ends.
+_ADB_SHELL_SENTINEL: bytes = b"__SUPERNOTE_CANVAS_DONE__"
+
 
+class _AdbShell:
+    """
+    A long-lived `adb shell` process used to run `screencap` repeatedly.
 
-def _capture_via_adb() -> Optional[bytes]:
+    Reusing one shell avoids paying the adb client/server handshake on every
+    capture. The screenshot (PNG or raw framebuffer) is base64-encoded on the
+    device so it can be read back as text lines terminated by a sentinel. Any
+    pipe error resets the process; the next call starts a fresh one.
+    """
+
+    def __init__(self) -> None:
+        self._proc: Optional[subprocess.Popen] = None
+        # Set when the device shell cannot produce base64 output (e.g. no
+        # `base64` binary); callers then fall back to `adb exec-out`.
+        self.unsupported = False
+        # Set when the device's raw framebuffer is in a pixel format we cannot
+        # decode; later captures then request PNG straight away.
+        self.raw_unsupported = False
+
+    def _ensure_proc(self) -> subprocess.Popen:
+        import subprocess
+
+        if self._proc is None or self._proc.poll() is not None:
+            cmd = ["adb"]
+            if ADB_DEVICE_SERIAL:
+                cmd.extend(["-s", ADB_DEVICE_SERIAL])
+            cmd.append("shell")
+            self._proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        return self._proc
+
+    def close(self) -> None:
+        """Terminate the shell process, if any."""
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.kill()
+            proc.wait(timeout=1)
+        except Exception:
+            pass
+
+    def screencap(self, timeout: float = 10.0, png: bool = True) -> Optional[bytes]:
+        """
+        Return the current screen, or None on failure.
+
+        With `png=True` the device encodes a PNG (`screencap -p`); otherwise the
+        raw framebuffer is returned (see `_encode_raw_screencap`).
+        """
+        try:
+            proc = self._ensure_proc()
+        except OSError:
+            return None
+
+        # Kill the shell if the device stops responding; readline() then hits EOF.
+        timer = threading.Timer(timeout, proc.kill)
+        timer.daemon = True
+        timer.start()
+        chunks = []
+        try:
+            assert proc.stdin is not None and proc.stdout is not None
+            command = b"screencap -p" if png else b"screencap"
+            proc.stdin.write(
+                command + b" 2>/dev/null | base64; echo " + _ADB_SHELL_SENTINEL + b"\n"
+            )
+            proc.stdin.flush()
+            while True:
+                line = proc.stdout.readline()
+                if not line:
+                    raise OSError("adb shell closed unexpectedly")
+                if line.strip() == _ADB_SHELL_SENTINEL:
+                    break
+                chunks.append(line)
+        except (OSError, ValueError):
+            self.close()
+            return None
+        finally:
+            timer.cancel()
+
+        try:
+            data = base64.b64decode(b"".join(chunks))
+        except (binascii.Error, ValueError):
+            data = b""
+        if not data:
+            self.unsupported = True
+            return None
+        return data
+
+
+_ADB_SHELL: Optional[_AdbShell] = None
+
+
+def _get_adb_shell() -> _AdbShell:
+    """Return the shared `_AdbShell`, creating it on first use."""
+    global _ADB_SHELL
+    if _ADB_SHELL is None:
+        _ADB_SHELL = _AdbShell()
+    return _ADB_SHELL
+
+
+def _capture_via_adb(timeout: float = 10.0) -> Optional[bytes]:
     """
     Capture screenshot via ADB and return as bytes, or None on failure.
 
-    Uses `adb exec-out screencap -p` to capture directly to stdout.
+    Prefers a persistent `adb shell` (see `_AdbShell`) and falls back to
+    `adb exec-out screencap` to capture directly to stdout. When Pillow is
+    available the raw framebuffer is fetched and PNG-encoded on the host,
+    which is much faster than the device's own encoder. All attempts share a
+    single `timeout`, so a hung device fails after one timeout, not several.
+    """
+    # Rely on the cached probe; a connected device implies ADB is available.
+    if not _is_device_connected():
+        return None
+
+    deadline = time.monotonic() + timeout
+
+    def remaining() -> float:
+        return deadline - time.monotonic()
+
+    shell = _get_adb_shell()
+    raw_ok = not shell.raw_unsupported and _get_pil() is not None
+    if not shell.unsupported:
+        data = shell.screencap(timeout=remaining(), png=not raw_ok)
+        if data and raw_ok:
+            data = _encode_raw_screencap(data)
+            if data is None:
+                # Unsupported pixel format; `exec-out` would return the same,
+                # so ask the device for PNG from now on.
+                shell.raw_unsupported = True
+                raw_ok = False
+                if remaining() > 0:
+                    data = shell.screencap(timeout=remaining())
+        if data:
+            return data
+
+    if raw_ok and remaining() > 0:
+        raw = _exec_out_screencap(timeout=remaining(), png=False)
+        if raw:
+            data = _encode_raw_screencap(raw)
+            if data:
+                return data
+            shell.raw_unsupported = True
+
+    if remaining() <= 0:
+        return None
+    return _exec_out_screencap(timeout=remaining())
+
+
+# `screencap` raw pixel formats with 4 bytes per pixel: RGBA_8888 and RGBX_8888.
+_RAW_SCREENCAP_FORMATS = (1, 2)
+
+
+def _encode_raw_screencap(raw: bytes) -> Optional[bytes]:
+    """
+    Convert raw `screencap` output (no `-p`) into PNG bytes, or None.
+
+    The raw stream starts with little-endian uint32 width, height and pixel
+    format, plus a colorspace field on newer Android versions, followed by the
+    pixels. Alpha is dropped (screenshots are opaque) and the PNG is written
+    with fast zlib settings.
     """
-    if not _is_adb_available() or not _is_device_connected():
+    pil = _get_pil()
+    if pil is None or len(raw) < 12:
+        return None
+    Image, _ = pil
+
+    width, height, pixel_format = struct.unpack_from("<3I", raw)
+    if pixel_format not in _RAW_SCREENCAP_FORMATS or not width or not height:
+        return None
+    header_size = len(raw) - width * height * 4
+    if header_size not in (12, 16):
         return None
 
     try:
-        cmd = ["adb"]
-        if ADB_DEVICE_SERIAL:
-            cmd.extend(["-s", ADB_DEVICE_SERIAL])
-        cmd.extend(["exec-out", "screencap", "-p"])
+        # frombytes (not frombuffer) so the RGBX -> RGB unpacking is applied.
+        img = Image.frombytes("RGB", (width, height), memoryview(raw)[header_size:], "raw", "RGBX")
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", compress_level=1)
+    except Exception:
+        return None
+    return buf.getvalue()
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            timeout=10,
-            check=True,
-        )
-        if result.stdout and len(result.stdout) > 0:
-            return result.stdout
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError, Exception):
-        pass
 
-    return None
+def _exec_out_screencap(timeout: float = 10.0, png: bool = True) -> Optional[bytes]:
+    """
+    Run `adb exec-out screencap` and return its stdout, or None on failure.
+
+    With `png=True` the device encodes a PNG (`screencap -p`); otherwise the
+    raw framebuffer is returned (see `_encode_raw_screencap`).
+
+    Output is streamed straight into a `BytesIO` instead of going through
+    `subprocess.run(capture_output=True)`, which keeps peak memory lower for
+    multi-megabyte PNGs.
+    """
+    import shutil
+    import subprocess
+
+    cmd = ["adb"]
+    if ADB_DEVICE_SERIAL:
+        cmd.extend(["-s", ADB_DEVICE_SERIAL])
+    cmd.extend(["exec-out", "screencap"])
+    if png:
+        cmd.append("-p")
+
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+
+    # copyfileobj blocks until EOF, so enforce the timeout by killing the process.
+    timer = threading.Timer(timeout, proc.kill)
+    timer.daemon = True
+    timer.start()
+    buf = io.BytesIO()
+    try:
+        assert proc.stdout is not None
+        shutil.copyfileobj(proc.stdout, buf)
+    except (OSError, ValueError):
+        return None
+    finally:
+        timer.cancel()
+        try:
+            # stdout is at EOF (or the timer fired), so the process is exiting;
+            # don't wait another full timeout for it.
+            returncode = proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            returncode = None
+        if proc.stdout is not None:
+            proc.stdout.close()
+
+    if returncode != 0 or buf.tell() == 0:
+        return None
+    return buf.getvalue()
+
+
+_IS_REMOTE: Optional[bool] = None
 
 
 def _is_remote_environment() -> bool:
     """
     Detect if running in a remote/hosted environment (Colab, JupyterHub, etc.).
 
-    Checks for common indicators of remote environments.
+    Checks for common indicators of remote environments. Cheap environment
+    variables are consulted before falling back to importing `google.colab`,
+    and the result is cached for the rest of the session.
     """
+    global _IS_REMOTE
+    if _IS_REMOTE is not None:
+        return _IS_REMOTE
+
+    # Check for Colab and JupyterHub (common env vars)
+    if (
+        os.getenv("COLAB_GPU") is not None
+        or os.getenv("JUPYTERHUB_USER")
+        or os.getenv("JUPYTERHUB_API_URL")
+    ):
+        _IS_REMOTE = True
+        return True
+
     # Check for Colab
     try:
         import google.colab  # type: ignore
+
+        _IS_REMOTE = True
         return True
     except ImportError:
         pass
 
-    # Check for JupyterHub (common env vars)
-    if os.getenv("JUPYTERHUB_USER") or os.getenv("JUPYTERHUB_API_URL"):
-        return True
-
     # Check if we can't access local filesystem reliably
     # (heuristic: if ADB device check fails and we're not on a typical local path)
     # This is a fallback heuristic
+    _IS_REMOTE = False
     return False
 
 
+# Memoized `(Image, ImageOps)` from Pillow; `_PIL_CHECKED` records that the
+# import was attempted so a missing Pillow is not re-imported on every capture.
+_PIL: Optional[tuple] = None
+_PIL_CHECKED: bool = False
+
+
+def _get_pil() -> Optional[tuple]:
+    """Return `(PIL.Image, PIL.ImageOps)`, or None if Pillow is unavailable."""
+    global _PIL, _PIL_CHECKED
+    if not _PIL_CHECKED:
+        _PIL_CHECKED = True
+        try:
+            from PIL import Image, ImageOps  # type: ignore
+
+            _PIL = (Image, ImageOps)
+        except Exception:
+            _PIL = None
+    return _PIL
+
+
+_PNG_SIGNATURE: bytes = b"\x89PNG\r\n\x1a\n"
+_JPEG_SIGNATURE: bytes = b"\xff\xd8\xff"
+
+# Pillow format name -> file extension for saved diagrams.
+_FORMAT_MAP: dict = {
+    "PNG": ".png",
+    "JPEG": ".jpg",
+    "JPEG2000": ".jpg",
+    "GIF": ".gif",
+    "WEBP": ".webp",
+    "BMP": ".bmp",
+}
+
+
+def _sniff_extension(image_data: bytes) -> Optional[str]:
+    """Return the file extension implied by the image's magic bytes, or None."""
+    if image_data.startswith(_PNG_SIGNATURE):
+        return ".png"
+    if image_data.startswith(_JPEG_SIGNATURE):
+        return ".jpg"
+    if image_data[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def _jpeg_exif_orientation(image_data: bytes) -> Optional[int]:
+    """
+    Return the EXIF Orientation (tag 0x0112) of JPEG data without Pillow.
+
+    Reads IFD0 of the `Exif` APP1 segment near the start of the file. Returns
+    1 when there is no EXIF data or no orientation tag, and None if the EXIF
+    block cannot be parsed.
+    """
+    start = image_data.find(b"Exif\x00\x00", 0, 65536)
+    if start < 0:
+        return 1
+    tiff = start + 6
+    byte_order = image_data[tiff : tiff + 2]
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        return None
+
+    try:
+        (ifd_offset,) = struct.unpack_from(endian + "I", image_data, tiff + 4)
+        pos = tiff + ifd_offset
+        (count,) = struct.unpack_from(endian + "H", image_data, pos)
+        for i in range(count):
+            entry = pos + 2 + 12 * i
+            (tag,) = struct.unpack_from(endian + "H", image_data, entry)
+            if tag == 0x0112:
+                (orientation,) = struct.unpack_from(endian + "H", image_data, entry + 8)
+                return orientation
+    except struct.error:
+        return None
+    return 1
+
+
+def _may_need_exif_transpose(image_data: bytes) -> bool:
+    """
+    Cheaply decide from the raw bytes whether EXIF orientation could apply.
+
+    Screenshots (PNG from `screencap -p` or the OS) carry no orientation tag,
+    and JPEGs whose EXIF orientation is missing or "normal" need no rotation;
+    both can be saved without opening them in Pillow. Unknown formats and
+    unparseable EXIF return True so Pillow gets to decide.
+    """
+    if image_data.startswith(_PNG_SIGNATURE):
+        return False
+    if image_data.startswith(_JPEG_SIGNATURE):
+        orientation = _jpeg_exif_orientation(image_data)
+        return orientation is None or orientation not in (0, 1)
+    return True
+
+
+# `(DIAGRAM_DIR, absolute path)` resolved on the first capture, so later
+# captures neither re-resolve against the cwd nor move if the notebook changes
+# directory. Re-resolved whenever `DIAGRAM_DIR` is reassigned.
+_DIAGRAM_DIR_RESOLVED: Optional[tuple[str, str]] = None
+
+# Absolute diagrams directory that has already been created, so captures skip
+# the `makedirs` call until the setting changes (or the directory disappears).
+_DIAGRAM_DIR_READY: Optional[str] = None
+
+
+def _abs_diagram_dir() -> str:
+    """Return `DIAGRAM_DIR` as an absolute path, cached until it is reassigned."""
+    global _DIAGRAM_DIR_RESOLVED
+    if _DIAGRAM_DIR_RESOLVED is None or _DIAGRAM_DIR_RESOLVED[0] != DIAGRAM_DIR:
+        _DIAGRAM_DIR_RESOLVED = (DIAGRAM_DIR, os.path.abspath(DIAGRAM_DIR))
+    return _DIAGRAM_DIR_RESOLVED[1]
+
+
 def _process_and_save_image(
-    image_data: bytes, source_path: Optional[str] = None
-) -> Optional[str]:
+    image_data: bytes,
+    source_path: Optional[str] = None,
+    log: Callable[[str], None] = print,
+) -> Optional[tuple[str, bytes]]:
     """
     Process image data and save to diagrams folder.
 
     Args:
         image_data: Image bytes to save
         source_path: Optional source file path (for extension detection)
+        log: Function used to report problems (defaults to `print`)
 
     Returns:
-        Path to saved file, or None on failure.
+        `(path, saved_bytes)` for the saved file, or None on failure. The bytes
+        let callers render a preview without reading the file back.
     """
     # Determine extension
     if source_path:
         src_ext = os.path.splitext(source_path)[1] or ".png"
     else:
-        # Try to detect from image data, default to PNG
-        src_ext = ".png"
-        try:
-            from PIL import Image  # type: ignore
+        # Try to detect from magic bytes, then Pillow; default to PNG
+        src_ext = _sniff_extension(image_data)
+        pil = _get_pil()
+        if src_ext is None and pil is not None:
+            Image, _ = pil
+            try:
+                with Image.open(io.BytesIO(image_data)) as img:
+                    src_ext = _FORMAT_MAP.get(img.format)
+            except Exception:
+                pass
+        src_ext = src_ext or ".png"
+
+    # Microsecond suffix keeps rapid successive captures from overwriting each
+    # other within the same second.
+    now = time.time()
+    timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(now)) + f"_{int(now * 1e6) % 1000000:06d}"
+    filename = f"diagram_{timestamp}{src_ext}"
 
+    global _DIAGRAM_DIR_READY
+    diagram_dir = _abs_diagram_dir()
+    if _DIAGRAM_DIR_READY != diagram_dir:
+        try:
+            os.makedirs(diagram_dir, exist_ok=True)
+        except OSError as exc:
+            log(f"Could not create diagrams directory '{DIAGRAM_DIR}': {exc}")
+            return None
+        _DIAGRAM_DIR_READY = diagram_dir
+
+    dest_path = os.path.join(diagram_dir, filename)
+
+    # Honor EXIF orientation flags using Pillow, if available. The transpose is
+    # done in memory so the file is written exactly once.
+    # Pillow may be missing; then EXIF handling is skipped.
+    saved = image_data
+    pil = _get_pil()
+    if pil is not None and _may_need_exif_transpose(image_data):
+        Image, ImageOps = pil
+        try:
             with Image.open(io.BytesIO(image_data)) as img:
-                # Map PIL format to extension
-                format_map = {"PNG": ".png", "JPEG": ".jpg", "JPEG2000": ".jpg"}
-                src_ext = format_map.get(img.format, ".png")
-        except Exception:
-            pass
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"diagram_{timestamp}{src_ext}"
+                # Only re-encode when an orientation other than "normal" is set;
+                # otherwise the original bytes are written unchanged.
+                if img.getexif().get(0x0112, 1) not in (0, 1):
+                    rotated = ImageOps.exif_transpose(img)
+                    buf = io.BytesIO()
+                    rotated.save(buf, format=img.format or "PNG")
+                    saved = buf.getvalue()
+        except Exception as exc:
+            # If anything goes wrong with EXIF-based rotation, continue without failing.
+            log(f"Could not apply EXIF-based rotation: {exc}")
+            saved = image_data
 
     try:
-        os.makedirs(DIAGRAM_DIR, exist_ok=True)
+        try:
+            with open(dest_path, "wb") as f:
+                f.write(saved)
+        except FileNotFoundError:
+            # The directory was removed since it was created; re-create it and
+            # retry once so this capture is not lost.
+            _DIAGRAM_DIR_READY = None
+            os.makedirs(diagram_dir, exist_ok=True)
+            _DIAGRAM_DIR_READY = diagram_dir
+            with open(dest_path, "wb") as f:
+                f.write(saved)
+        return dest_path, saved
     except OSError as exc:
-        print(f"Could not create diagrams directory '{DIAGRAM_DIR}': {exc}")
+        log(f"Failed to save image to '{dest_path}': {exc}")
         return None
 
-    dest_path = os.path.join(DIAGRAM_DIR, filename)
 
-    try:
-        # Write image data to file
-        with open(dest_path, "wb") as f:
-            f.write(image_data)
+def _extract_upload(value: object) -> Optional[tuple[bytes, str]]:
+    """
+    Return `(content, filename)` for the first file in a `FileUpload` value.
 
-        # Attempt to honor EXIF orientation flags using Pillow, if available.
-        try:
-            from PIL import Image, ImageOps  # type: ignore
+    Handles ipywidgets 8 (a tuple of dicts with `content` and `name`) first and
+    falls back to the ipywidgets 7 layout (a dict of `{"content", "metadata"}`
+    dicts keyed by filename). Returns None if nothing has been uploaded.
+    """
+    if not value:
+        return None
 
-            try:
-                with Image.open(dest_path) as img:
-                    rotated = ImageOps.exif_transpose(img)
-                    rotated.save(dest_path)
-            except Exception as exc:
-                # If anything goes wrong with EXIF-based rotation, continue without failing.
-                print(f"Could not apply EXIF-based rotation: {exc}")
-        except Exception:
-            # Pillow is not installed or failed to import; skip EXIF handling.
-            pass
+    if isinstance(value, (tuple, list)):
+        uploaded = value[0]
+        content = uploaded.get("content")
+        name = uploaded.get("name", "")
+    elif isinstance(value, dict):
+        uploaded = next(iter(value.values()))
+        if isinstance(uploaded, tuple):
+            # Format: (content, metadata)
+            content = uploaded[0]
+            name = uploaded[1].get("name", "") if len(uploaded) > 1 else ""
+        else:
+            content = uploaded.get("content")
+            name = uploaded.get("metadata", {}).get("name", "")
+    else:
+        return None
 
-        return dest_path
-    except OSError as exc:
-        print(f"Failed to save image to '{dest_path}': {exc}")
+    if not content:
+        return None
+    # ipywidgets 8 exposes the content as a memoryview.
+    return bytes(content), name
+
+
+# Largest preview edge in pixels; matches the width the preview is shown at.
+_PREVIEW_MAX_SIZE: int = 800
+
+
+def _make_preview(image_data: bytes) -> Optional[bytes]:
+    """
+    Return a downscaled JPEG preview of `image_data`, or None.
+
+    Full-resolution screenshots are several megabytes once base64-encoded for
+    the frontend, while the preview is only shown 800px wide. Returns None when
+    Pillow is unavailable, decoding fails, or the image is already small enough
+    to send as-is.
+    """
+    pil = _get_pil()
+    if pil is None:
         return None
+    Image, _ = pil
 
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            if max(img.size) <= _PREVIEW_MAX_SIZE:
+                return None
+            # draft() lets the JPEG decoder downscale while decoding.
+            img.draft("RGB", (_PREVIEW_MAX_SIZE, _PREVIEW_MAX_SIZE))
+            if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+                # JPEG has no alpha; flatten onto white so transparent areas
+                # (e.g. macOS window-capture shadows) do not render black.
+                rgba = img.convert("RGBA")
+                preview = Image.new("RGB", img.size, "white")
+                preview.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                preview = img.convert("RGB")
+        resample = getattr(Image, "Resampling", Image).LANCZOS
+        preview.thumbnail((_PREVIEW_MAX_SIZE, _PREVIEW_MAX_SIZE), resample)
+        buf = io.BytesIO()
+        preview.save(buf, format="JPEG", quality=85)
+    except Exception:
+        return None
+    return buf.getvalue()
+
+
+# Single background worker that saves and renders captures, so large images do
+# not block the kernel while the widget callback runs. Created on first use.
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Return the shared single-thread `ThreadPoolExecutor`, creating it if needed."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        _EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="supernote_canvas")
+    return _EXECUTOR
+
+
+# HTML for the Supernote panel header and iframe. Filled in with `.format()` at
+# draw time; literal braces in the inline JavaScript are doubled.
+_IFRAME_TEMPLATE: str = """
+<div style="border: 1px solid #ccc; border-radius: 6px; padding: 10px; margin-bottom: 8px;">
+  <h4 style="margin-top: 0; font-family: sans-serif;">
+    Supernote Canvas
+  </h4>
+  <p style="margin: 4px 0 10px; font-family: sans-serif; font-size: 13px; color: #555;">
+    {instruction_text}
+  </p>
+  <button 
+    onclick="
+      const iframe = document.getElementById('{iframe_id}');
+      const originalSrc = {supernote_url_js};
+      iframe.src = '';
+      setTimeout(() => {{
+        iframe.src = originalSrc + (originalSrc.includes('?') ? '&' : '?') + '_t=' + Date.now();
+      }}, 100);
+    "
+    style="
+      padding: 4px 8px;
+      margin-bottom: 8px;
+      background-color: #f8f9fa;
+      border: 1px solid #ddd;
+      border-radius: 3px;
+      cursor: pointer;
+      font-size: 12px;
+      font-family: sans-serif;
+    "
+    onmouseover="this.style.backgroundColor='#e9ecef'"
+    onmouseout="this.style.backgroundColor='#f8f9fa'"
+  >
+    🔄 Refresh iframe
+  </button>
+  <p style="margin: 4px 0 8px; font-family: sans-serif; font-size: 11px; color: #999;">
+    If blocked, try: reload the Jupyter page (Cmd/Ctrl+R) or use Chrome with <code>--allow-running-insecure-content</code>
+  </p>
+  <div id="{iframe_id}_container" style="position: relative; width: 100%;">
+    <button 
+      onclick="
+        const container = document.getElementById('{iframe_id}_container');
+        const iframe = document.getElementById('{iframe_id}');
+        if (container.style.position === 'fixed') {{
+          // Exit fullscreen
+          container.style.position = 'relative';
+          container.style.top = 'auto';
+          container.style.left = 'auto';
+          container.style.width = '100%';
+          container.style.height = 'auto';
+          container.style.zIndex = 'auto';
+          container.style.backgroundColor = 'transparent';
+          iframe.style.height = '80vh';
+          this.textContent = '⛶ Fullscreen';
+        }} else {{
+          // Enter fullscreen
+          container.style.position = 'fixed';
+          container.style.top = '0';
+          container.style.left = '0';
+          container.style.width = '100vw';
+          container.style.height = '100vh';
+          container.style.zIndex = '9999';
+          container.style.backgroundColor = 'rgba(0,0,0,0.9)';
+          iframe.style.height = '100vh';
+          this.textContent = '✕ Exit Fullscreen';
+        }}
+      "
+      style="
+        position: absolute;
+        top: 8px;
+        right: 8px;
+        padding: 6px 12px;
+        background-color: rgba(0,0,0,0.7);
+        color: white;
+        border: 1px solid rgba(255,255,255,0.3);
+        border-radius: 4px;
+        cursor: pointer;
+        font-size: 12px;
+        font-family: sans-serif;
+        z-index: 10000;
+      "
+      onmouseover="this.style.backgroundColor='rgba(0,0,0,0.9)'"
+      onmouseout="this.style.backgroundColor='rgba(0,0,0,0.7)'"
+    >
+      ⛶ Fullscreen
+    </button>
+    <iframe
+      id="{iframe_id}"
+      src="{supernote_url}"
+      width="100%"
+      height="80vh"
+      style="border: 1px solid #aaa; border-radius: 4px; min-height: 600px;"
+      allow="camera; microphone; fullscreen"
+      referrerpolicy="no-referrer-when-downgrade"
+      loading="lazy"
+    ></iframe>
+  </div>
+</div>
+"""
 
-def _display_captured_image(dest_path: str) -> None:
-    """Display the captured image with Markdown instructions and clipboard copy."""
+# HTML for a "copy to clipboard" button. `js_text` must already be a JSON/JS
+# string literal (see `json.dumps`), HTML-escaped for use inside an attribute.
+_COPY_BUTTON_TEMPLATE: str = """
+<button 
+    onclick="navigator.clipboard.writeText({js_text}).then(() => {{
+        this.textContent = '✓ Copied!';
+        this.style.backgroundColor = '#28a745';
+        setTimeout(() => {{
+            this.textContent = '{label}';
+            this.style.backgroundColor = '';
+        }}, 2000);
+    }}).catch(err => {{
+        // Fallback for older browsers
+        const textarea = document.createElement('textarea');
+        textarea.value = {js_text};
+        textarea.style.position = 'fixed';
+        textarea.style.opacity = '0';
+        document.body.appendChild(textarea);
+        textarea.select();
+        try {{
+            document.execCommand('copy');
+            this.textContent = '✓ Copied!';
+            this.style.backgroundColor = '#28a745';
+            setTimeout(() => {{
+                this.textContent = '{label}';
+                this.style.backgroundColor = '';
+            }}, 2000);
+        }} catch (err) {{
+            alert('Failed to copy. Please copy manually.');
+        }}
+        document.body.removeChild(textarea);
+    }});"
+    style="
+        padding: 6px 12px;
+        margin: 8px 0;
+        background-color: #007bff;
+        color: white;
+        border: none;
+        border-radius: 4px;
+        cursor: pointer;
+        font-size: 13px;
+        font-family: sans-serif;
+    "
+    onmouseover="this.style.backgroundColor='#0056b3'"
+    onmouseout="this.style.backgroundColor='#007bff'"
+>
+    {label}
+</button>
+"""
+
+
+def _display_captured_image(
+    dest_path: str,
+    image_data: Optional[bytes] = None,
+    emit: Optional[Callable[[object], None]] = None,
+    log: Callable[[str], None] = print,
+) -> None:
+    """
+    Display the captured image with Markdown instructions and clipboard copy.
+
+    `image_data` is the saved file's content; when given, the preview is built
+    from it instead of re-reading `dest_path`. `emit` receives each display
+    object (defaults to `IPython.display.display`); pass an Output widget's
+    `append_display_data` when calling from a background thread. `log`
+    reports problems (defaults to `print`).
+    """
     # Lazy import for display functions
     try:
         from IPython.display import HTML, Image as IPImage, display  # type: ignore
-        import json
     except Exception:
-        print("Failed to import display dependencies")
+        log("Failed to import display dependencies")
         return
 
+    if emit is None:
+        emit = display
+
     # Get absolute path
     abs_path = os.path.abspath(dest_path)
     
@@ -279,136 +1000,60 @@ def _display_captured_image(dest_path: str) -> None:
     # Build Markdown pointing to the new file.
     md = f"![Diagram]({md_path})"
 
-    # Escape markdown for JavaScript using JSON encoding (safest method)
-    js_safe_md = json.dumps(md)
+    # Escape markdown for JavaScript using JSON encoding (safest method), then
+    # HTML-escape it since it sits inside a double-quoted onclick attribute.
+    js_safe_md = html.escape(json.dumps(md))
 
     # Create copy button with JavaScript
-    copy_button_html = f"""
-    <button 
-        onclick="navigator.clipboard.writeText({js_safe_md}).then(() => {{
-            this.textContent = '✓ Copied!';
-            this.style.backgroundColor = '#28a745';
-            setTimeout(() => {{
-                this.textContent = '📋 Copy Markdown';
-                this.style.backgroundColor = '';
-            }}, 2000);
-        }}).catch(err => {{
-            // Fallback for older browsers
-            const textarea = document.createElement('textarea');
-            textarea.value = {js_safe_md};
-            textarea.style.position = 'fixed';
-            textarea.style.opacity = '0';
-            document.body.appendChild(textarea);
-            textarea.select();
-            try {{
-                document.execCommand('copy');
-                this.textContent = '✓ Copied!';
-                this.style.backgroundColor = '#28a745';
-                setTimeout(() => {{
-                    this.textContent = '📋 Copy Markdown';
-                    this.style.backgroundColor = '';
-                }}, 2000);
-            }} catch (err) {{
-                alert('Failed to copy. Please copy manually.');
-            }}
-            document.body.removeChild(textarea);
-        }});"
-        style="
-            padding: 6px 12px;
-            margin: 8px 0;
-            background-color: #007bff;
-            color: white;
-            border: none;
-            border-radius: 4px;
-            cursor: pointer;
-            font-size: 13px;
-            font-family: sans-serif;
-        "
-        onmouseover="this.style.backgroundColor='#0056b3'"
-        onmouseout="this.style.backgroundColor='#007bff'"
-    >
-        📋 Copy Markdown
-    </button>
-    """
+    copy_button_html = _COPY_BUTTON_TEMPLATE.format(js_text=js_safe_md, label="📋 Copy Markdown")
+
+    # All instructions go out as a single HTML display (one comm message);
+    # each part is wrapped in a <div> to keep the original stacked layout.
+    parts = []
 
     # Check if we're in Colab - use IPython.display.Image() instead of markdown
     try:
         import google.colab  # type: ignore
         # In Colab, markdown doesn't work with local files, use code cell instead
         code_snippet = f'from IPython import display\ndisplay.Image("{md_path}")'
-        display(HTML("<strong>Copy this code into a code cell:</strong>"))
-        safe_code = code_snippet.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-        display(HTML(f"<code style='display: block; padding: 8px; background: #f5f5f5; border-radius: 4px;'>{safe_code}</code>"))
-        
+        parts.append("<strong>Copy this code into a code cell:</strong>")
+        safe_code = html.escape(code_snippet, quote=False)
+        parts.append(f"<code style='display: block; padding: 8px; background: #f5f5f5; border-radius: 4px;'>{safe_code}</code>")
+
         # Create copy button for code snippet
-        js_safe_code = json.dumps(code_snippet)
-        code_copy_button = f"""
-        <button 
-            onclick="navigator.clipboard.writeText({js_safe_code}).then(() => {{
-                this.textContent = '✓ Copied!';
-                this.style.backgroundColor = '#28a745';
-                setTimeout(() => {{
-                    this.textContent = '📋 Copy Code';
-                    this.style.backgroundColor = '';
-                }}, 2000);
-            }}).catch(err => {{
-                const textarea = document.createElement('textarea');
-                textarea.value = {js_safe_code};
-                textarea.style.position = 'fixed';
-                textarea.style.opacity = '0';
-                document.body.appendChild(textarea);
-                textarea.select();
-                try {{
-                    document.execCommand('copy');
-                    this.textContent = '✓ Copied!';
-                    this.style.backgroundColor = '#28a745';
-                    setTimeout(() => {{
-                        this.textContent = '📋 Copy Code';
-                        this.style.backgroundColor = '';
-                    }}, 2000);
-                }} catch (err) {{
-                    alert('Failed to copy. Please copy manually.');
-                }}
-                document.body.removeChild(textarea);
-            }});"
-            style="
-                padding: 6px 12px;
-                margin: 8px 0;
-                background-color: #007bff;
-                color: white;
-                border: none;
-                border-radius: 4px;
-                cursor: pointer;
-                font-size: 13px;
-                font-family: sans-serif;
-            "
-            onmouseover="this.style.backgroundColor='#0056b3'"
-            onmouseout="this.style.backgroundColor='#007bff'"
-        >
-            📋 Copy Code
-        </button>
-        """
-        display(HTML(code_copy_button))
+        js_safe_code = html.escape(json.dumps(code_snippet))
+        code_copy_button = _COPY_BUTTON_TEMPLATE.format(js_text=js_safe_code, label="📋 Copy Code")
+        parts.append(code_copy_button)
     except ImportError:
         # Not in Colab, use markdown
-        display(HTML("<strong>Markdown to copy into a new markdown cell:</strong>"))
+        parts.append("<strong>Markdown to copy into a new markdown cell:</strong>")
         # Render as <code> block; escaping minimal HTML special chars.
-        safe_md = md.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-        display(HTML(f"<code>{safe_md}</code>"))
-        display(HTML(copy_button_html))
-    
-    display(HTML("<strong>Preview (for reference only):</strong>"))
+        safe_md = html.escape(md, quote=False)
+        parts.append(f"<code>{safe_md}</code>")
+        parts.append(copy_button_html)
+
+    parts.append("<strong>Preview (for reference only):</strong>")
+    emit(HTML("".join(f"<div>{part}</div>" for part in parts)))
 
     # Try IPython Image first, fallback to HTML img tag
     try:
-        display(IPImage(filename=dest_path, width=800))
+        preview = _make_preview(image_data) if image_data is not None else None
+        if preview is not None:
+            emit(IPImage(data=preview, format="jpeg"))
+        elif image_data is not None:
+            emit(IPImage(data=image_data, width=800))
+        else:
+            emit(IPImage(filename=dest_path, width=800))
     except Exception:
         # Fallback: use HTML img tag (works better in some environments)
         try:
-            display(HTML(f'<img src="{md_path}" alt="Diagram preview" style="max-width: 800px; border: 1px solid #ddd; border-radius: 4px;">'))
+            emit(HTML(f'<img src="{md_path}" alt="Diagram preview" style="max-width: 800px; border: 1px solid #ddd; border-radius: 4px;">'))
         except Exception as exc:  # pragma: no cover - environment/display specific
-            print(f"Could not display image preview: {exc}")
+            log(f"Could not display image preview: {exc}")
+
 
+# Shown in the output widget while a capture runs; matched to remove it again.
+_PLACEHOLDER_HTML: str = "<em>Capturing…</em>"
 
 
 def draw() -> None:
@@ -433,7 +1078,9 @@ def draw() -> None:
 
     # Detect environment and available methods
     is_remote = _is_remote_environment()
-    adb_available = _is_adb_available() and _is_device_connected()
+    # ADB probes are cached (see `invalidate_adb_cache`); evaluate once here and
+    # reuse the result in the click handler below.
+    adb_available = _is_device_connected()
 
     # Build instruction text based on environment
     if is_remote:
@@ -452,104 +1099,15 @@ def draw() -> None:
 
     # Build iframe HTML with a small heading and instructions.
     # Include a refresh button to reload the iframe (helps with browser security prompts)
-    import time
     iframe_id = f"supernote_iframe_{int(time.time() * 1000)}"
-    iframe_html = f"""
-    <div style="border: 1px solid #ccc; border-radius: 6px; padding: 10px; margin-bottom: 8px;">
-      <h4 style="margin-top: 0; font-family: sans-serif;">
-        Supernote Canvas
-      </h4>
-      <p style="margin: 4px 0 10px; font-family: sans-serif; font-size: 13px; color: #555;">
-        {instruction_text}
-      </p>
-      <button 
-        onclick="
-          const iframe = document.getElementById('{iframe_id}');
-          const originalSrc = '{SUPERNOTE_URL}';
-          iframe.src = '';
-          setTimeout(() => {{
-            iframe.src = originalSrc + (originalSrc.includes('?') ? '&' : '?') + '_t=' + Date.now();
-          }}, 100);
-        "
-        style="
-          padding: 4px 8px;
-          margin-bottom: 8px;
-          background-color: #f8f9fa;
-          border: 1px solid #ddd;
-          border-radius: 3px;
-          cursor: pointer;
-          font-size: 12px;
-          font-family: sans-serif;
-        "
-        onmouseover="this.style.backgroundColor='#e9ecef'"
-        onmouseout="this.style.backgroundColor='#f8f9fa'"
-      >
-        🔄 Refresh iframe
-      </button>
-      <p style="margin: 4px 0 8px; font-family: sans-serif; font-size: 11px; color: #999;">
-        If blocked, try: reload the Jupyter page (Cmd/Ctrl+R) or use Chrome with <code>--allow-running-insecure-content</code>
-      </p>
-      <div id="{iframe_id}_container" style="position: relative; width: 100%;">
-        <button 
-          onclick="
-            const container = document.getElementById('{iframe_id}_container');
-            const iframe = document.getElementById('{iframe_id}');
-            if (container.style.position === 'fixed') {{
-              // Exit fullscreen
-              container.style.position = 'relative';
-              container.style.top = 'auto';
-              container.style.left = 'auto';
-              container.style.width = '100%';
-              container.style.height = 'auto';
-              container.style.zIndex = 'auto';
-              container.style.backgroundColor = 'transparent';
-              iframe.style.height = '80vh';
-              this.textContent = '⛶ Fullscreen';
-            }} else {{
-              // Enter fullscreen
-              container.style.position = 'fixed';
-              container.style.top = '0';
-              container.style.left = '0';
-              container.style.width = '100vw';
-              container.style.height = '100vh';
-              container.style.zIndex = '9999';
-              container.style.backgroundColor = 'rgba(0,0,0,0.9)';
-              iframe.style.height = '100vh';
-              this.textContent = '✕ Exit Fullscreen';
-            }}
-          "
-          style="
-            position: absolute;
-            top: 8px;
-            right: 8px;
-            padding: 6px 12px;
-            background-color: rgba(0,0,0,0.7);
-            color: white;
-            border: 1px solid rgba(255,255,255,0.3);
-            border-radius: 4px;
-            cursor: pointer;
-            font-size: 12px;
-            font-family: sans-serif;
-            z-index: 10000;
-          "
-          onmouseover="this.style.backgroundColor='rgba(0,0,0,0.9)'"
-          onmouseout="this.style.backgroundColor='rgba(0,0,0,0.7)'"
-        >
-          ⛶ Fullscreen
-        </button>
-        <iframe
-          id="{iframe_id}"
-          src="{SUPERNOTE_URL}"
-          width="100%"
-          height="80vh"
-          style="border: 1px solid #aaa; border-radius: 4px; min-height: 600px;"
-          allow="camera; microphone; fullscreen"
-          referrerpolicy="no-referrer-when-downgrade"
-          loading="lazy"
-        ></iframe>
-      </div>
-    </div>
-    """
+    iframe_html = _IFRAME_TEMPLATE.format(
+        instruction_text=instruction_text,
+        iframe_id=iframe_id,
+        # The URL is used as the iframe src attribute and as a JS string inside
+        # the onclick attribute; the latter is JSON-encoded, then HTML-escaped.
+        supernote_url=html.escape(SUPERNOTE_URL),
+        supernote_url_js=html.escape(json.dumps(SUPERNOTE_URL)),
+    )
 
     iframe = widgets.HTML(value=iframe_html)
 
@@ -600,85 +1158,111 @@ def draw() -> None:
     )
 
     def _on_capture_click(_btn: widgets.Button) -> None:
-        """Handle the Capture button click with priority-based method selection."""
-        output.clear_output()
-
-        with output:
-            image_data: Optional[bytes] = None
-            source_path: Optional[str] = None
-            capture_method = ""
-
-            # Priority 1: Try ADB capture (local environments only)
-            if not is_remote and adb_available:
-                image_data = _capture_via_adb()
-                if image_data:
-                    capture_method = "USB (ADB)"
-
-            # Priority 2: Try file upload (remote environments)
-            if image_data is None and is_remote and upload_widget:
+        """Handle the Capture button click by starting a background capture."""
+        # Ignore clicks (and upload events) while a capture is in flight, so a
+        # double-click does not scan, decode and write the image twice. The
+        # button is re-enabled once the result has been rendered.
+        if capture_btn.disabled:
+            return
+        capture_btn.disabled = True
+
+        # Show a placeholder right away; the capture itself (ADB, file reads,
+        # EXIF handling, preview) runs on the worker thread.
+        # clear_output() only messages the frontend and leaves `outputs` intact
+        # on the kernel side, so reset the outputs directly.
+        output.outputs = ()
+        output.append_display_data(HTML(_PLACEHOLDER_HTML))
+        try:
+            _get_executor().submit(_capture_and_display)
+        except Exception:
+            capture_btn.disabled = False
+            raise
+
+    def _log_to_output(message: str) -> None:
+        """Append a line of text to the output widget (safe from any thread)."""
+        output.append_stdout(message + "\n")
+
+    def _acquire_image() -> tuple[Optional[bytes], Optional[str]]:
+        """Return `(image_data, source_path)` using priority-based method selection."""
+        image_data: Optional[bytes] = None
+        source_path: Optional[str] = None
+
+        # Priority 1: Try ADB capture (local environments only)
+        if not is_remote and adb_available:
+            image_data = _capture_via_adb()
+
+        # Priority 2: Try file upload (remote environments)
+        if image_data is None and is_remote and upload_widget:
+            try:
+                uploaded = _extract_upload(upload_widget.value)
+                if uploaded is not None:
+                    image_data, source_path = uploaded
+            except Exception as exc:
+                _log_to_output(f"Error reading uploaded file: {exc}")
+
+        # Priority 3: Fallback to folder-based method (local environments)
+        if image_data is None and not is_remote:
+            src = _latest_screenshot(SCREENSHOT_DIR)
+            if src:
                 try:
-                    # FileUpload widget value is a dict with file metadata
-                    if upload_widget.value:
-                        # Handle different possible structures
-                        if isinstance(upload_widget.value, dict):
-                            # Get the first (and only) uploaded file
-                            file_list = list(upload_widget.value.values())
-                            if file_list:
-                                uploaded_file = file_list[0]
-                                # Handle both dict format and tuple format
-                                if isinstance(uploaded_file, dict):
-                                    image_data = uploaded_file.get("content")
-                                    source_path = uploaded_file.get("metadata", {}).get("name", "")
-                                elif isinstance(uploaded_file, tuple) and len(uploaded_file) >= 2:
-                                    # Format: (content, metadata)
-                                    image_data = uploaded_file[0]
-                                    source_path = uploaded_file[1].get("name", "") if len(uploaded_file) > 1 else ""
-                                
-                                if image_data:
-                                    capture_method = "file upload"
-                except Exception as exc:
-                    print(f"Error reading uploaded file: {exc}")
-
-            # Priority 3: Fallback to folder-based method (local environments)
-            if image_data is None and not is_remote:
-                src = _latest_screenshot(SCREENSHOT_DIR)
-                if src:
-                    try:
-                        with open(src, "rb") as f:
-                            image_data = f.read()
-                        source_path = src
-                        capture_method = "folder"
-                    except OSError as exc:
-                        print(f"Failed to read screenshot file: {exc}")
+                    with open(src, "rb") as f:
+                        image_data = f.read()
+                    source_path = src
+                except OSError as exc:
+                    _log_to_output(f"Failed to read screenshot file: {exc}")
+
+        return image_data, source_path
+
+    def _drop_placeholder() -> None:
+        """Remove the "Capturing…" placeholder, keeping every other output."""
+        # Output.clear_output() enters the widget's context, which is unreliable
+        # off the main thread, so the outputs are filtered directly.
+        output.outputs = tuple(
+            o for o in output.outputs
+            if o.get("data", {}).get("text/html") != _PLACEHOLDER_HTML
+        )
+
+    def _capture_and_display() -> None:
+        """Capture, save and render a screenshot (runs on the worker thread)."""
+        placeholder_shown = True
+        try:
+            image_data, source_path = _acquire_image()
+            _drop_placeholder()
+            placeholder_shown = False
 
             # If we still don't have image data, show error
             if image_data is None:
                 if is_remote:
-                    print(
+                    _log_to_output(
                         "No screenshot uploaded.\n"
                         "Please use the file upload widget above to select a screenshot file."
                     )
+                elif adb_available:
+                    _log_to_output(
+                        f"ADB capture failed. No screenshot files found in '{SCREENSHOT_DIR}'.\n"
+                        "Make sure you have taken a screenshot as .png, .jpg, or .jpeg, "
+                        "or check your USB connection."
+                    )
                 else:
-                    if adb_available:
-                        print(
-                            f"ADB capture failed. No screenshot files found in '{SCREENSHOT_DIR}'.\n"
-                            "Make sure you have taken a screenshot as .png, .jpg, or .jpeg, "
-                            "or check your USB connection."
-                        )
-                    else:
-                        print(
-                            f"No screenshot files found in '{SCREENSHOT_DIR}'.\n"
-                            "Make sure you have taken a screenshot as .png, .jpg, or .jpeg."
-                        )
+                    _log_to_output(
+                        f"No screenshot files found in '{SCREENSHOT_DIR}'.\n"
+                        "Make sure you have taken a screenshot as .png, .jpg, or .jpeg."
+                    )
                 return
 
-            # Process and save the image
-            dest_path = _process_and_save_image(image_data, source_path)
-            if dest_path is None:
+            saved = _process_and_save_image(image_data, source_path, log=_log_to_output)
+            if saved is None:
                 return
-
-            # Display the result
-            _display_captured_image(dest_path)
+            dest_path, saved_data = saved
+            _display_captured_image(
+                dest_path, saved_data, emit=output.append_display_data, log=_log_to_output
+            )
+        except Exception as exc:
+            if placeholder_shown:
+                _drop_placeholder()
+            _log_to_output(f"Failed to capture image: {exc}")
+        finally:
+            capture_btn.disabled = False
 
     def _on_close_click(_btn: widgets.Button) -> None:
         """Handle the Close button click: close the container widget."""
@@ -699,24 +1283,38 @@ def draw() -> None:
     display(container)
 
 
+# Set once `%diagram` is registered. Read back from globals() so that
+# `importlib.reload` / autoreload (which re-run this module in the same
+# namespace) keep the flag; the registered magic looks up `draw` at call time,
+# so it picks up reloaded code without re-registering.
+_MAGIC_REGISTERED: bool = globals().get("_MAGIC_REGISTERED", False)
+
+
 def _register_line_magic(ipython=None) -> None:
     """
     Register the `%diagram` line magic with the current IPython instance.
 
-    Safe to call multiple times; will do nothing outside IPython.
+    Safe to call multiple times; will do nothing outside IPython or once the
+    magic has been registered.
     """
-    if not _in_ipython():
-        return
-
-    try:
-        from IPython import get_ipython  # type: ignore
-    except Exception:
+    global _MAGIC_REGISTERED
+    if _MAGIC_REGISTERED:
         return
 
     # Prefer explicit ipython instance if provided, else fall back to global.
-    shell = ipython or get_ipython()
+    # The memoized `_in_ipython()` check avoids importing IPython when no
+    # shell is running.
+    shell = ipython
     if shell is None:
-        return
+        if not _in_ipython():
+            return
+        try:
+            from IPython import get_ipython  # type: ignore
+        except Exception:
+            return
+        shell = get_ipython()
+        if shell is None:
+            return
 
     def diagram(line: str = "") -> None:
         """Launch the Supernote drawing helper UI."""
@@ -726,6 +1324,7 @@ def _register_line_magic(ipython=None) -> None:
     # Register as a line magic named "diagram".
     try:
         shell.register_magic_function(diagram, magic_kind="line", magic_name="diagram")
+        _MAGIC_REGISTERED = True
     except Exception:
         # Fallback: try decorator-based registration if available.
         try:
@@ -737,6 +1336,7 @@ def _register_line_magic(ipython=None) -> None:
                 draw()
 
             _ = diagram_magic  # silence unused warning
+            _MAGIC_REGISTERED = True
         except Exception:
             # If this also fails, just give up silently; importing the module should still work.
             return